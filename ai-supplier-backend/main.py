@@ -1,12 +1,18 @@
 from fastapi import FastAPI, HTTPException, Depends, status, Security
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from typing import List, Optional, Dict, Any, Union
+from typing import List, Optional, Dict, Any, Tuple, Union
 from pydantic import BaseModel
 from datetime import datetime, timedelta
+import asyncio
+import logging
 import os
+import time
+from functools import lru_cache
 from dotenv import load_dotenv
 from supabase import create_client, Client
+from postgrest.exceptions import APIError
 from langchain_core.messages import HumanMessage, AIMessage
 from langchain_openai import ChatOpenAI
 from langgraph.graph import Graph
@@ -14,13 +20,21 @@ from langchain_core.runnables import RunnablePassthrough
 import json
 import re
 import jwt
-from tenacity import retry, stop_after_attempt, wait_exponential
+import httpx
+import openai
+import numpy as np
+from tenacity import AsyncRetrying, retry, stop_after_attempt, wait_exponential, retry_if_exception, retry_if_exception_type
+from cachetools import TTLCache
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError, WatchError
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Security
 security = HTTPBearer()
@@ -36,20 +50,104 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Size of the Supabase/PgBouncer connection pool; HTTP connections and
+# concurrent requests are capped to match it
+SUPABASE_POOL_SIZE = int(os.getenv("SUPABASE_POOL_SIZE", "15"))
+
 # Initialize Supabase client
 supabase: Client = create_client(
     os.getenv("SUPABASE_URL"),
     os.getenv("SUPABASE_SERVICE_KEY")
 )
 
+def configure_postgrest_pool(client: Client):
+    # supabase-py doesn't accept an HTTP client through ClientOptions, so swap
+    # the PostgREST session for a pooled keep-alive one with the same settings
+    postgrest = client.postgrest
+    session = postgrest.session
+    postgrest.session = httpx.Client(
+        base_url=session.base_url,
+        headers=session.headers,
+        timeout=session.timeout,
+        limits=httpx.Limits(
+            max_connections=SUPABASE_POOL_SIZE,
+            max_keepalive_connections=SUPABASE_POOL_SIZE
+        ),
+        http2=True
+    )
+    session.close()
+
+configure_postgrest_pool(supabase)
+
+# Reused request builder for the products hot path; bound to the pooled session
+# above. Each call still starts its own select(), since filters mutate the
+# select builder in place
+products_table = supabase.table("products")
+
+supabase_semaphore = asyncio.Semaphore(SUPABASE_POOL_SIZE)
+
+# PostgREST codes for failing to reach or get a connection from the database
+TRANSIENT_POSTGREST_CODES = {"PGRST000", "PGRST001", "PGRST002", "PGRST003"}
+# Errors raised before the request reached the server, so nothing was written
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+def is_transient_error(exc: BaseException) -> bool:
+    if isinstance(exc, httpx.TransportError):
+        return True
+    if isinstance(exc, APIError):
+        # Non-JSON error bodies (e.g. a 503 from the proxy) carry the HTTP
+        # status as the code
+        code = str(exc.code)
+        return code in TRANSIENT_POSTGREST_CODES or (len(code) == 3 and code.startswith("5"))
+    return False
+
+async def execute_async(query, idempotent: bool = True):
+    # Retry transient failures with a short backoff before surfacing a 500.
+    # Writes are only retried when the request never reached the server, so a
+    # timeout after a committed insert doesn't write the rows twice
+    retrying = AsyncRetrying(
+        stop=stop_after_attempt(3),
+        wait=wait_exponential(multiplier=0.1, max=1.0),
+        retry=retry_if_exception(is_transient_error) if idempotent else retry_if_exception_type(CONNECT_ERRORS),
+        reraise=True
+    )
+    async for attempt in retrying:
+        with attempt:
+            # supabase-py is synchronous, so run requests in a worker thread to
+            # keep the event loop free; the semaphore is released between attempts
+            async with supabase_semaphore:
+                return await asyncio.to_thread(query.execute)
+
 # Initialize LLM
 llm = ChatOpenAI(
     openai_api_key=os.getenv("OPENAI_API_KEY"),
     model_name="gpt-3.5-turbo"
 )
 
-# Memory cache for user preferences
-user_preferences = {}
+# Redis store for user preferences, shared between workers
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+redis_client: Optional[aioredis.Redis] = None
+
+# Bounded local cache in front of Redis, holding (model, serialized dict) pairs.
+# Once full, TTLCache evicts the least recently used user. A size or TTL of 0
+# disables it and every lookup goes to Redis
+PREFERENCES_CACHE_SIZE = int(os.getenv("PREFERENCES_CACHE_SIZE", "10000"))
+PREFERENCES_CACHE_TTL = int(os.getenv("PREFERENCES_CACHE_TTL", "60"))
+user_preferences: Optional[TTLCache] = (
+    TTLCache(maxsize=PREFERENCES_CACHE_SIZE, ttl=PREFERENCES_CACHE_TTL)
+    if PREFERENCES_CACHE_SIZE > 0 and PREFERENCES_CACHE_TTL > 0
+    else None
+)
+
+@app.on_event("startup")
+async def init_redis():
+    global redis_client
+    redis_client = aioredis.from_url(REDIS_URL, decode_responses=True)
+
+@app.on_event("shutdown")
+async def close_redis():
+    if redis_client is not None:
+        await redis_client.aclose()
 
 class Token(BaseModel):
     access_token: str
@@ -78,36 +176,181 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
     return encoded_jwt
 
+@lru_cache(maxsize=10_000)
+def _decode_cached(token: str, now_bucket: int) -> dict:
+    # now_bucket changes every 30s, so cached entries are dropped naturally
+    return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+
 def verify_token(credentials: HTTPAuthorizationCredentials = Security(security)):
     try:
-        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        return payload
+        payload = _decode_cached(credentials.credentials, int(time.time() // 30))
+        # A cache hit skips the expiry check done by jwt.decode
+        if "exp" in payload and payload["exp"] <= time.time():
+            raise jwt.ExpiredSignatureError
+        return dict(payload)
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token has expired")
     except jwt.JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-# User preferences management
-def get_user_preferences(user_id: str) -> UserPreferences:
-    if user_id not in user_preferences:
-        user_preferences[user_id] = UserPreferences()
-    return user_preferences[user_id]
+# Batched chat history writes
+CHAT_BATCH_SIZE = 500  # keeps a single insert well under Postgres' parameter limit
+CHAT_FLUSH_INTERVAL = 0.1  # seconds
+chat_message_queue: Optional[asyncio.Queue] = None
+chat_flusher_task: Optional[asyncio.Task] = None
+# Queued on shutdown to tell the flusher to finish its batch and stop
+CHAT_QUEUE_STOP = object()
+
+async def insert_chat_messages(batch: List[Dict[str, Any]]):
+    await execute_async(supabase.table("chat_messages").insert(batch), idempotent=False)
+
+async def write_chat_messages(batch: List[Dict[str, Any]]):
+    # Never raises, so neither the flusher nor the shutdown hook is interrupted
+    try:
+        await insert_chat_messages(batch)
+    except APIError as e:
+        if len(batch) == 1 or is_transient_error(e):
+            logger.exception("Failed to insert %d chat messages", len(batch))
+            return
+        # A single bad row rejects the whole insert; write the rows one at a
+        # time so only the offending ones are lost
+        logger.warning("Batch insert of %d chat messages failed, retrying row by row: %s", len(batch), e)
+        for message in batch:
+            try:
+                await insert_chat_messages([message])
+            except Exception:
+                logger.exception("Failed to insert chat message")
+    except Exception:
+        logger.exception("Failed to insert %d chat messages", len(batch))
 
-def update_user_preferences(user_id: str, query: str, results: QueryResult):
-    prefs = get_user_preferences(user_id)
+async def collect_chat_batch() -> Tuple[List[Dict[str, Any]], bool]:
+    # Block for the first message, then take whatever arrives until the batch
+    # is full or the flush interval has passed. Also reports whether the stop
+    # sentinel was reached
+    batch = []
+    loop = asyncio.get_running_loop()
+    deadline = None
+    while len(batch) < CHAT_BATCH_SIZE:
+        if deadline is None:
+            message = await chat_message_queue.get()
+        else:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                message = await asyncio.wait_for(chat_message_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+        if message is CHAT_QUEUE_STOP:
+            return batch, True
+        batch.append(message)
+        if deadline is None:
+            deadline = loop.time() + CHAT_FLUSH_INTERVAL
+    return batch, False
+
+async def flush_chat_messages():
+    while True:
+        batch, stopping = await collect_chat_batch()
+        if batch:
+            await write_chat_messages(batch)
+        if stopping:
+            return
+
+@app.on_event("startup")
+async def start_chat_flusher():
+    global chat_message_queue, chat_flusher_task
+    chat_message_queue = asyncio.Queue()
+    chat_flusher_task = asyncio.create_task(flush_chat_messages())
+
+@app.on_event("shutdown")
+async def stop_chat_flusher():
+    # Let the flusher write the batch it is holding and exit on its own
+    chat_message_queue.put_nowait(CHAT_QUEUE_STOP)
+    await chat_flusher_task
     
-    # Update last queries
-    prefs.last_queries = [query] + prefs.last_queries[:4]
+    # Write out anything still queued
+    batch = []
+    while not chat_message_queue.empty():
+        batch.append(chat_message_queue.get_nowait())
+        if len(batch) == CHAT_BATCH_SIZE:
+            await write_chat_messages(batch)
+            batch = []
+    if batch:
+        await write_chat_messages(batch)
+
+@app.on_event("shutdown")
+async def close_supabase():
+    # Registered after the chat flusher so queued messages are written first
+    supabase.postgrest.session.close()
+
+# User preferences management
+def preferences_key(user_id: str) -> str:
+    return f"prefs:{user_id}"
+
+def cache_user_preferences(user_id: str, prefs: UserPreferences) -> Tuple[UserPreferences, Dict[str, Any]]:
+    # Keep the serialized form next to the model so requests can embed it in
+    # metadata without dumping the model again; rebuilt on every write
+    entry = (prefs, prefs.model_dump(mode="python"))
+    if user_preferences is not None:
+        user_preferences[user_id] = entry
+    return entry
+
+async def get_user_preferences_entry(user_id: str) -> Tuple[UserPreferences, Dict[str, Any]]:
+    entry = user_preferences.get(user_id) if user_preferences is not None else None
+    if entry is None:
+        try:
+            raw = await redis_client.get(preferences_key(user_id))
+        except RedisError:
+            # Preferences only enrich the query, so answer without them rather
+            # than fail; not cached, so the next request tries Redis again
+            logger.exception("Failed to load preferences for user %s", user_id)
+            prefs = UserPreferences()
+            return prefs, prefs.model_dump(mode="python")
+        prefs = UserPreferences.model_validate_json(raw) if raw else UserPreferences()
+        entry = cache_user_preferences(user_id, prefs)
+    return entry
+
+async def update_user_preferences(user_id: str, query: str, results: QueryResult):
+    # Read-modify-write against Redis rather than the local cache, which may be
+    # stale; WATCH retries the update if another worker writes in between
+    key = preferences_key(user_id)
+    try:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(key)
+                    raw = await pipe.get(key)
+                    prefs = UserPreferences.model_validate_json(raw) if raw else UserPreferences()
+                    
+                    # Update last queries
+                    prefs.last_queries = [query] + prefs.last_queries[:4]
+                    
+                    # Update preferred categories and brands from successful searches
+                    if results.products:
+                        categories = [p["category"] for p in results.products]
+                        brands = [p["brand"] for p in results.products]
+                        
+                        # dict.fromkeys dedups in a single pass and keeps insertion order
+                        prefs.preferred_categories = list(dict.fromkeys(prefs.preferred_categories + categories))[:5]
+                        prefs.preferred_brands = list(dict.fromkeys(prefs.preferred_brands + brands))[:5]
+                    
+                    pipe.multi()
+                    pipe.set(key, prefs.model_dump_json())
+                    await pipe.execute()
+                    break
+                except WatchError:
+                    continue
+    except RedisError:
+        logger.exception("Failed to update preferences for user %s", user_id)
+        return
     
-    # Update preferred categories and brands from successful searches
-    if results.products:
-        categories = set(p["category"] for p in results.products)
-        brands = set(p["brand"] for p in results.products)
-        
-        prefs.preferred_categories = list(set(prefs.preferred_categories) | categories)[:5]
-        prefs.preferred_brands = list(set(prefs.preferred_brands) | brands)[:5]
+    cache_user_preferences(user_id, prefs)
 
 # Product comparison
+COMPARISON_FIELDS = ["name", "brand", "price", "category", "description"]
+# Only the columns the comparison reads are fetched from the products table
+COMPARISON_COLUMNS = ",".join(["id"] + COMPARISON_FIELDS)
+
 @app.post("/api/compare")
 async def compare_products(
     request: ComparisonRequest,
@@ -121,73 +364,174 @@ async def compare_products(
         raise HTTPException(status_code=500, detail=str(e))
 
 async def get_products_by_ids(product_ids: List[str]):
-    result = supabase.table("products").select("*").in_("id", product_ids).execute()
-    return result.data
+    result = await execute_async(products_table.select(COMPARISON_COLUMNS).in_("id", product_ids))
+    # Return products in the order they were requested, not the order PostgREST used
+    position = {product_id: i for i, product_id in enumerate(product_ids)}
+    return sorted(result.data, key=lambda p: position.get(p["id"], len(position)))
+
+# Below this many products plain Python beats the cost of building an array
+NUMPY_PRICE_THRESHOLD = 16
+
+def price_stats(products: List[Dict[str, Any]]):
+    if len(products) <= NUMPY_PRICE_THRESHOLD:
+        prices = [p["price"] for p in products]
+        return float(min(prices)), float(max(prices)), float(sum(prices) / len(prices))
+    
+    prices = np.fromiter((p["price"] for p in products), dtype=np.float64, count=len(products))
+    return float(prices.min()), float(prices.max()), float(prices.mean())
 
 def create_comparison_analysis(products: List[Dict[str, Any]]):
     if not products:
         return {"error": "No products found"}
     
     # Create comparison matrix
-    fields = ["name", "brand", "price", "category", "description"]
+    lowest, highest, average = price_stats(products)
     comparison = {
         "products": products,
         "differences": {},
         "similarities": {},
         "price_comparison": {
-            "lowest": min(p["price"] for p in products),
-            "highest": max(p["price"] for p in products),
-            "average": sum(p["price"] for p in products) / len(products)
+            "lowest": lowest,
+            "highest": highest,
+            "average": average
         }
     }
     
-    # Analyze differences and similarities
-    for field in fields:
-        values = set(str(p[field]) for p in products)
-        if len(values) > 1:
-            comparison["differences"][field] = {
-                p["id"]: p[field] for p in products
-            }
+    # Analyze differences and similarities over a column-per-field layout
+    ids = [p["id"] for p in products]
+    columns = {field: [p[field] for p in products] for field in COMPARISON_FIELDS}
+    for field, column in columns.items():
+        first = column[0]
+        if all(value == first for value in column):
+            comparison["similarities"][field] = first
         else:
-            comparison["similarities"][field] = list(values)[0]
+            # Products grouped by value, so each distinct value is sent once
+            groups = {}
+            for product_id, value in zip(ids, column):
+                groups.setdefault(value, []).append(product_id)
+            comparison["differences"][field] = [
+                {"value": value, "ids": group_ids} for value, group_ids in groups.items()
+            ]
     
     return comparison
 
 # Analytics
+def message_confidence(msg: Dict[str, Any]) -> float:
+    try:
+        return msg["metadata"]["confidence_score"]
+    except (KeyError, TypeError):
+        return 0
+
 @app.get("/api/analytics")
 async def get_analytics(token: dict = Depends(verify_token)):
     try:
-        # Get query history
-        history = supabase.table("chat_messages").select("*").execute()
-        
-        # Calculate analytics
-        total_queries = len(history.data)
-        categories = {}
-        confidence_sum = 0
-        confidence_count = 0
-        
-        for msg in history.data:
-            if msg.get("metadata", {}).get("search_terms", {}).get("category"):
-                category = msg["metadata"]["search_terms"]["category"]
-                categories[category] = categories.get(category, 0) + 1
-            
-            if msg.get("metadata", {}).get("confidence_score"):
-                confidence_sum += msg["metadata"]["confidence_score"]
-                confidence_count += 1
+        # Aggregate in the database and fetch only the latest queries
+        summary, recent = await asyncio.gather(
+            execute_async(supabase.rpc("analytics_summary", {})),
+            execute_async(
+                supabase.table("chat_messages")
+                .select("content,created_at,metadata")
+                .order("created_at", desc=True)
+                .limit(10)
+            )
+        )
+        stats = summary.data[0]
         
         return AnalyticsData(
-            total_queries=total_queries,
-            popular_categories=categories,
-            average_confidence=confidence_sum / confidence_count if confidence_count > 0 else 0,
+            total_queries=stats["total_queries"],
+            popular_categories=stats["popular_categories"],
+            average_confidence=stats["average_confidence"],
             query_history=[{
                 "query": msg["content"],
                 "timestamp": msg["created_at"],
-                "confidence": msg.get("metadata", {}).get("confidence_score", 0)
-            } for msg in history.data[-10:]]  # Last 10 queries
+                "confidence": message_confidence(msg)
+            } for msg in reversed(recent.data)]  # Last 10 queries, oldest first
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Rate limits are left to the openai client's own retries, which back off for
+# longer and honour Retry-After
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=0.1, max=1.0),
+    retry=retry_if_exception_type((
+        openai.APIConnectionError,
+        openai.InternalServerError
+    )),
+    reraise=True
+)
+async def run_query_workflow(query: str, user_id: str, filters: Dict[str, Any]):
+    return await query_workflow.arun(
+        query,
+        config={
+            "metadata": {
+                "user_id": user_id,
+                "filters": filters
+            }
+        }
+    )
+
+# Suggestions returned to the client, keyed by the kind of failure and checked
+# in this order
+ERROR_KIND_RE = re.compile(r"(database|processing)", re.IGNORECASE)
+ERROR_SUGGESTIONS = {
+    "database": "There seems to be an issue with the database. Please try again in a moment.",
+    "processing": "The query could not be processed. Please try simplifying your request."
+}
+
+# Identical queries in flight, keyed by (user_id, query, filters); followers
+# await the leader's task instead of repeating the LLM and database work
+MAX_INFLIGHT_QUERIES = 1_000
+inflight_queries: Dict[Tuple[str, str, str], asyncio.Task] = {}
+
+# Strong references to pending preference updates so they aren't garbage collected
+preference_updates = set()
+
+async def answer_query(request: QueryRequest) -> QueryResponse:
+    # Get user preferences
+    prefs, prefs_dict = await get_user_preferences_entry(request.user_id)
+    
+    # Enhance query with user preferences
+    enhanced_filters = request.filters or {}
+    if prefs.preferred_categories:
+        enhanced_filters["preferred_categories"] = prefs.preferred_categories
+    if prefs.preferred_brands:
+        enhanced_filters["preferred_brands"] = prefs.preferred_brands
+    
+    # Execute workflow
+    result = await run_query_workflow(request.query, request.user_id, enhanced_filters)
+    
+    # Update user preferences without holding up the response. Scheduled here
+    # rather than on one caller's BackgroundTasks, which never run if that
+    # client disconnects while others are still waiting on this query
+    update = asyncio.create_task(update_user_preferences(request.user_id, request.query, result))
+    preference_updates.add(update)
+    update.add_done_callback(preference_updates.discard)
+    
+    # Save to chat history with enhanced metadata
+    now = datetime.now()
+    chat_message = {
+        "role": "assistant",
+        "content": result,
+        "user_id": request.user_id,
+        "metadata": {
+            "query": request.query,
+            "filters": enhanced_filters,
+            "preferences": prefs_dict,
+            "timestamp": now.isoformat()
+        }
+    }
+    
+    # Queued for the batch flusher; doesn't wait on the database
+    chat_message_queue.put_nowait(chat_message)
+    
+    return QueryResponse(
+        content=result,
+        created_at=now,
+        metadata=chat_message["metadata"]
+    )
+
 # Enhanced query processing with memory
 @app.post("/api/query")
 async def process_query(
@@ -195,60 +539,31 @@ async def process_query(
     token: dict = Depends(verify_token)
 ):
     try:
-        # Get user preferences
-        prefs = get_user_preferences(request.user_id)
-        
-        # Enhance query with user preferences
-        enhanced_filters = request.filters or {}
-        if prefs.preferred_categories:
-            enhanced_filters["preferred_categories"] = prefs.preferred_categories
-        if prefs.preferred_brands:
-            enhanced_filters["preferred_brands"] = prefs.preferred_brands
-        
-        # Execute workflow
-        result = await query_workflow.arun(
-            request.query,
-            config={
-                "metadata": {
-                    "user_id": request.user_id,
-                    "filters": enhanced_filters
-                }
-            }
-        )
+        key = (request.user_id, request.query, json.dumps(request.filters, sort_keys=True, default=str))
+        task = inflight_queries.get(key)
+        if task is not None:
+            return await asyncio.shield(task)
         
-        # Update user preferences
-        update_user_preferences(request.user_id, request.query, result)
-        
-        # Save to chat history with enhanced metadata
-        chat_message = {
-            "role": "assistant",
-            "content": result,
-            "user_id": request.user_id,
-            "metadata": {
-                "query": request.query,
-                "filters": enhanced_filters,
-                "preferences": prefs.dict(),
-                "timestamp": datetime.now().isoformat()
-            }
-        }
-        
-        supabase.table("chat_messages").insert(chat_message).execute()
-        
-        return QueryResponse(
-            content=result,
-            created_at=datetime.now(),
-            metadata=chat_message["metadata"]
-        )
+        task = asyncio.create_task(answer_query(request))
+        if len(inflight_queries) < MAX_INFLIGHT_QUERIES:
+            inflight_queries[key] = task
+        try:
+            # Shielded so a disconnecting client doesn't cancel work others await
+            return await asyncio.shield(task)
+        finally:
+            if inflight_queries.get(key) is task:
+                del inflight_queries[key]
         
     except Exception as e:
         error_message = str(e)
-        suggestion = "Please try rephrasing your query or providing more specific details."
+        kinds = {kind.lower() for kind in ERROR_KIND_RE.findall(error_message)}
+        # Database problems take precedence wherever they appear in the message
+        kind = next((k for k in ERROR_SUGGESTIONS if k in kinds), None)
+        suggestion = ERROR_SUGGESTIONS.get(
+            kind,
+            "Please try rephrasing your query or providing more specific details."
+        )
         
-        if "database" in error_message.lower():
-            suggestion = "There seems to be an issue with the database. Please try again in a moment."
-        elif "processing" in error_message.lower():
-            suggestion = "The query could not be processed. Please try simplifying your request."
-            
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail={
@@ -32,8 +32,10 @@ export interface ChatMessage {
 export interface ComparisonResult {
   products: Product[];
   differences: {
+    // Products grouped by their value for the field
     [key: string]: {
-      [productId: string]: any;
-    };
+      value: any;
+      ids: string[];
+    }[];
   };
 }
\ No newline at end of file
@@ -0,0 +1,44 @@
+/*
+  # Analytics summary
+
+  1. Changes
+    - chat_messages
+      - user_id (text), the user the message was sent for
+      - metadata (jsonb), written by the API alongside each message
+
+  2. Functions
+    - analytics_summary()
+      - total_queries (bigint)
+      - average_confidence (double precision)
+      - popular_categories (jsonb, category -> message count)
+*/
+
+ALTER TABLE chat_messages
+ADD COLUMN IF NOT EXISTS user_id text,
+ADD COLUMN IF NOT EXISTS metadata jsonb DEFAULT '{}'::jsonb;
+
+CREATE OR REPLACE FUNCTION analytics_summary()
+RETURNS TABLE (
+  total_queries bigint,
+  average_confidence double precision,
+  popular_categories jsonb
+)
+LANGUAGE sql
+STABLE
+AS $$
+  SELECT
+    (SELECT count(*) FROM chat_messages),
+    (
+      SELECT coalesce(avg(nullif((metadata->>'confidence_score')::float, 0)), 0)
+      FROM chat_messages
+    ),
+    (
+      SELECT coalesce(jsonb_object_agg(category, cnt), '{}'::jsonb)
+      FROM (
+        SELECT metadata->'search_terms'->>'category' AS category, count(*) AS cnt
+        FROM chat_messages
+        WHERE coalesce(metadata->'search_terms'->>'category', '') <> ''
+        GROUP BY 1
+      ) categories
+    );
+$$;
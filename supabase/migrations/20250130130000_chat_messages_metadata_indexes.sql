@@ -0,0 +1,48 @@
+/*
+  # chat_messages metadata indexes
+
+  1. Indexes
+    - chat_messages_category_idx on metadata->'search_terms'->>'category'
+    - chat_messages_conf_idx on (metadata->>'confidence_score')::float
+    - chat_messages_metadata_idx (GIN) on metadata, for key-existence filters
+
+  2. Functions
+    - analytics_summary() only scans rows that carry the keys it aggregates
+*/
+
+CREATE INDEX IF NOT EXISTS chat_messages_category_idx
+ON chat_messages ((metadata->'search_terms'->>'category'));
+
+CREATE INDEX IF NOT EXISTS chat_messages_conf_idx
+ON chat_messages (((metadata->>'confidence_score')::float));
+
+CREATE INDEX IF NOT EXISTS chat_messages_metadata_idx
+ON chat_messages USING gin (metadata);
+
+CREATE OR REPLACE FUNCTION analytics_summary()
+RETURNS TABLE (
+  total_queries bigint,
+  average_confidence double precision,
+  popular_categories jsonb
+)
+LANGUAGE sql
+STABLE
+AS $$
+  SELECT
+    (SELECT count(*) FROM chat_messages),
+    (
+      SELECT coalesce(avg(nullif((metadata->>'confidence_score')::float, 0)), 0)
+      FROM chat_messages
+      WHERE metadata ? 'confidence_score'
+    ),
+    (
+      SELECT coalesce(jsonb_object_agg(category, cnt), '{}'::jsonb)
+      FROM (
+        SELECT metadata->'search_terms'->>'category' AS category, count(*) AS cnt
+        FROM chat_messages
+        WHERE metadata ? 'search_terms'
+          AND coalesce(metadata->'search_terms'->>'category', '') <> ''
+        GROUP BY 1
+      ) categories
+    );
+$$;
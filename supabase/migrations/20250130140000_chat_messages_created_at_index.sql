@@ -0,0 +1,10 @@
+/*
+  # chat_messages recency index
+
+  1. Indexes
+    - chat_messages_created_at_idx on created_at, so the latest messages
+      for analytics are read from the index instead of sorting the table
+*/
+
+CREATE INDEX IF NOT EXISTS chat_messages_created_at_idx
+ON chat_messages (created_at DESC);